@@ -1,20 +1,64 @@
 # scrap_table.py
 import os
-import json
-import uuid
+import random
+import re
+import time
+import orjson
+from urllib.parse import urlencode
 import requests
 import boto3
+from boto3.dynamodb.types import DYNAMODB_CONTEXT, TypeSerializer
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from itertools import islice
 from decimal import Decimal, InvalidOperation
-from datetime import datetime
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Config (si quieres usar env vars, puedes definir TABLE_NAME en serverless.yml)
 TABLE_NAME = os.environ.get("TABLE_NAME", "TablaWebScrapping")
-dynamodb = boto3.resource("dynamodb")
-table_db = dynamodb.Table(TABLE_NAME)
+# keep-alive + pool: en invocaciones warm se reutiliza la conexión TCP/TLS
+BOTO_CONFIG = Config(
+    tcp_keepalive=True,
+    max_pool_connections=10,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+# cliente de bajo nivel: los items viajan ya serializados por to_dynamo_attr y se evita
+# la capa de transformación del resource, que los recorre en cada request
+dynamodb = boto3.client("dynamodb", config=BOTO_CONFIG)
+SERIALIZER = TypeSerializer()
+
+# límite de operaciones por BatchWriteItem y reintentos para UnprocessedItems
+BATCH_SIZE = 25
+BATCH_MAX_ATTEMPTS = 5
+
+# hilo para solapar el scan de DynamoDB con el fetch a ArcGIS (ambos son I/O)
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# primar la conexión (DNS + TLS) durante el INIT del cold start, no en la invocación
+try:
+    dynamodb.describe_endpoints()
+except Exception:
+    pass
 
 ARC_URL = "https://ide.igp.gob.pe/arcgis/rest/services/monitoreocensis/SismosReportados/MapServer/0/query"
+# la query es fija salvo resultRecordCount: se codifica una sola vez
+ARC_QUERY_URL = ARC_URL + "?" + urlencode({
+    "where": "1=1",
+    "outFields": "*",
+    "orderByFields": "fecha DESC",
+    "f": "json"
+})
+
+# sesión a nivel de módulo: la conexión HTTPS a ArcGIS se reutiliza entre invocaciones warm
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4))
+SESSION.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+
+# normalización de strings numéricos: sufijo "km" fuera, coma decimal -> punto, sin zero-width space
+_KM_RE = re.compile(r"\s*km")
+_NUM_TRANS = str.maketrans({",": ".", "\u200b": None})
 
 def to_decimal_safe(v):
     if v is None:
@@ -29,8 +73,7 @@ def to_decimal_safe(v):
         except (InvalidOperation, ValueError):
             return None
     if isinstance(v, str):
-        s = v.strip().replace(" km", "").replace("km", "").replace(",", ".")
-        s = s.replace("\u200b", "")
+        s = _KM_RE.sub("", v.strip()).translate(_NUM_TRANS)
         try:
             return Decimal(s)
         except (InvalidOperation, ValueError):
@@ -42,70 +85,126 @@ def to_decimal_safe(v):
 
 def convert_decimals(obj):
     """
-    Convierte recursivamente Decimal -> float (u otro tipo JSON-serializable).
+    Convierte Decimal -> float (u otro tipo JSON-serializable) en toda la estructura.
+    Recorrido iterativo con pila explícita sobre una copia; no modifica el original.
     Mantiene el resto de tipos intactos.
     """
-    if isinstance(obj, Decimal):
-        # convertimos a float para mantener tipo numérico en JSON
-        return float(obj)
-    if isinstance(obj, dict):
-        return {k: convert_decimals(v) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [convert_decimals(v) for v in obj]
-    if isinstance(obj, tuple):
-        return tuple(convert_decimals(v) for v in obj)
-    # otros tipos (str, int, bool, None)
-    return obj
+    root = [obj]
+    stack = [(root, 0, obj)]
+    tuples = []
+    while stack:
+        parent, key, value = stack.pop()
+        t = type(value)
+        if t is Decimal:
+            # convertimos a float para mantener tipo numérico en JSON
+            parent[key] = float(value)
+        elif t is dict:
+            copy = dict(value)
+            parent[key] = copy
+            stack.extend((copy, k, v) for k, v in value.items())
+        elif t is list or t is tuple:
+            copy = list(value)
+            parent[key] = copy
+            if t is tuple:
+                tuples.append((parent, key))
+            stack.extend((copy, i, v) for i, v in enumerate(value))
+        # otros tipos (str, int, bool, None) se quedan como están
+    # las tuplas se reconstruyen al final, de la más interna a la más externa
+    for parent, key in reversed(tuples):
+        parent[key] = tuple(parent[key])
+    return root[0]
+
+# alias posibles de cada campo en los atributos de ArcGIS, en orden de preferencia
+FECHA_KEYS = ("fecha", "Fecha")
+MAG_KEYS = ("mag", "MAG", "magnitud", "magn")
+PROF_KEYS = ("profundidad", "PROFUNDIDAD", "depth", "z")
+REF_KEYS = ("referencia", "Referencia", "ref", "referencia_texto")
+LAT_KEYS = ("lat", "LAT", "latitude")
+LON_KEYS = ("lon", "LON", "longitude")
+ID_KEYS = ("OBJECTID", "OBJECTID_1", "id", "ID")
+
+# tipos que se guardan tal cual en raw_attributes
+RAW_SCALAR_TYPES = (str, int, bool, type(None))
+
+def _pick(d, keys):
+    """Devuelve el primer valor no vacío (ni None ni "") entre las claves candidatas."""
+    for k in keys:
+        v = d.get(k)
+        if v is not None and v != "":
+            return v
+    return None
+
+@lru_cache(maxsize=256)
+def _fecha_iso(fecha_ms):
+    # los mismos sismos vuelven en cada invocación: se formatea cada epoch una sola vez.
+    # Mismo formato que datetime.isoformat(): fracción con microsegundos solo si no es cero
+    secs, ms = divmod(fecha_ms, 1000)
+    micro = int(round(ms * 1000))
+    if micro >= 1000000:
+        secs, micro = secs + 1, micro - 1000000
+    base = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(secs))
+    if micro:
+        return base + ".%06d" % micro + "Z"
+    return base + "Z"
 
 def fetch_latest_sismos(limit=10):
-    params = {
-        "where": "1=1",
-        "outFields": "*",
-        "orderByFields": "fecha DESC",
-        "resultRecordCount": str(limit),
-        "f": "json"
-    }
-    resp = requests.get(ARC_URL, params=params, timeout=15)
+    url = ARC_QUERY_URL + "&resultRecordCount=" + str(int(limit))
+    resp = SESSION.get(url, timeout=15)
     resp.raise_for_status()
-    data = resp.json()
+    data = orjson.loads(resp.content)
     features = data.get("features", []) or []
     items = []
     for feat in features:
         attr = feat.get("attributes", {}) or {}
         geom = feat.get("geometry", {}) or {}
 
+        # solo se guardan los campos con valor: el item ya sale listo para DynamoDB
         item = {}
-        fecha_val = attr.get("fecha") or attr.get("Fecha")
+        fecha_val = _pick(attr, FECHA_KEYS)
         if isinstance(fecha_val, (int, float)):
             try:
-                item["fecha_iso"] = datetime.utcfromtimestamp(fecha_val / 1000).isoformat() + "Z"
+                item["fecha_iso"] = _fecha_iso(fecha_val)
             except Exception:
                 item["fecha_raw"] = str(fecha_val)
-        else:
-            item["fecha_raw"] = str(fecha_val) if fecha_val is not None else None
+        elif fecha_val is not None:
+            item["fecha_raw"] = str(fecha_val)
 
-        mag = attr.get("mag") or attr.get("MAG") or attr.get("magnitud") or attr.get("magn")
-        item["magnitud"] = to_decimal_safe(mag)
+        mag = to_decimal_safe(_pick(attr, MAG_KEYS))
+        if mag is not None:
+            item["magnitud"] = mag
 
-        prof = attr.get("profundidad") or attr.get("PROFUNDIDAD") or attr.get("depth") or attr.get("z")
-        item["profundidad_km"] = to_decimal_safe(prof)
+        prof = to_decimal_safe(_pick(attr, PROF_KEYS))
+        if prof is not None:
+            item["profundidad_km"] = prof
 
-        item["referencia_texto"] = (attr.get("referencia") or attr.get("Referencia") or
-                                    attr.get("ref") or attr.get("referencia_texto") or None)
+        ref = _pick(attr, REF_KEYS)
+        if ref:
+            item["referencia_texto"] = ref
 
-        lat = geom.get("y") or attr.get("lat") or attr.get("LAT") or attr.get("latitude")
-        lon = geom.get("x") or attr.get("lon") or attr.get("LON") or attr.get("longitude")
-        item["latitude"] = to_decimal_safe(lat)
-        item["longitude"] = to_decimal_safe(lon)
+        lat = geom.get("y")
+        if lat is None:
+            lat = _pick(attr, LAT_KEYS)
+        lat = to_decimal_safe(lat)
+        if lat is not None:
+            item["latitude"] = lat
+        lon = geom.get("x")
+        if lon is None:
+            lon = _pick(attr, LON_KEYS)
+        lon = to_decimal_safe(lon)
+        if lon is not None:
+            item["longitude"] = lon
 
-        item["report_id"] = (attr.get("OBJECTID") or attr.get("OBJECTID_1") or
-                             attr.get("id") or attr.get("ID") or None)
+        report_id = _pick(attr, ID_KEYS)
+        if report_id is not None:
+            item["report_id"] = report_id
+            # OBJECTID es único en la capa: id estable para que el put sobrescriba (upsert)
+            item["id"] = "sismo-" + str(report_id)
 
         raw = {}
         for k, v in attr.items():
             if isinstance(v, float):
                 raw[k] = to_decimal_safe(v)
-            elif isinstance(v, (str, int, bool)) or v is None:
+            elif isinstance(v, RAW_SCALAR_TYPES):
                 raw[k] = v
             else:
                 try:
@@ -117,69 +216,145 @@ def fetch_latest_sismos(limit=10):
         items.append(item)
     return items
 
-def clean_item_for_dynamo(item):
-    return {k: v for k, v in item.items() if v is not None}
+def to_dynamo_attr(v):
+    """
+    Serializa un valor al formato de atributo de DynamoDB ({"S": ...}, {"N": ...}, ...).
+    Los items solo llevan str/int/bool/None/Decimal y dicts de ellos: se resuelven por tipo
+    exacto sin pasar por TypeSerializer. Los números pasan igual por DYNAMODB_CONTEXT
+    (38 dígitos, rango de DynamoDB), así que un valor inválido falla aquí, antes de escribir
+    nada; cualquier otro tipo (o un Decimal no finito) cae en SERIALIZER.
+    """
+    t = type(v)
+    if t is str:
+        return {"S": v}
+    if t is int or (t is Decimal and v.is_finite()):
+        return {"N": str(DYNAMODB_CONTEXT.create_decimal(v))}
+    if t is bool:
+        return {"BOOL": v}
+    if v is None:
+        return {"NULL": True}
+    if t is dict:
+        return {"M": {k: to_dynamo_attr(x) for k, x in v.items()}}
+    return SERIALIZER.serialize(v)
+
+def scan_existing_ids():
+    ids = set()
+    # el scan devuelve como máximo 1 MB por página: paginar con ExclusiveStartKey
+    scan_kwargs = {"ProjectionExpression": "id"}
+    while True:
+        scan_resp = dynamodb.scan(TableName=TABLE_NAME, **scan_kwargs)
+        for it in scan_resp.get("Items", []) or []:
+            if "id" in it:
+                ids.add(it["id"]["S"])
+        last_key = scan_resp.get("LastEvaluatedKey")
+        if not last_key:
+            break
+        scan_kwargs["ExclusiveStartKey"] = last_key
+    return ids
+
+def batch_write(write_requests):
+    """
+    Envía PutRequest/DeleteRequest ya serializados en BatchWriteItem de BATCH_SIZE.
+    Reintenta los UnprocessedItems con backoff exponencial con jitter.
+    """
+    it = iter(write_requests)
+    while True:
+        chunk = list(islice(it, BATCH_SIZE))
+        if not chunk:
+            break
+        pending = {TABLE_NAME: chunk}
+        for attempt in range(BATCH_MAX_ATTEMPTS):
+            resp = dynamodb.batch_write_item(RequestItems=pending)
+            pending = resp.get("UnprocessedItems") or {}
+            if not pending:
+                break
+            # sin espera tras el último intento: se lanza el error directamente
+            if attempt + 1 < BATCH_MAX_ATTEMPTS:
+                time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+        if pending:
+            raise RuntimeError("UnprocessedItems tras %d intentos: %d operaciones"
+                               % (BATCH_MAX_ATTEMPTS, len(pending.get(TABLE_NAME, []))))
 
 def lambda_handler(event, context):
     result = {"fetched": 0, "saved": 0, "table_after_save_count": 0, "errors": [], "sample_saved": []}
 
+    # el scan de ids previos no depende del fetch: corre en paralelo con la llamada a ArcGIS
+    existing_future = EXECUTOR.submit(scan_existing_ids)
+
     try:
         sismos = fetch_latest_sismos(limit=10)
         result["fetched"] = len(sismos)
         if not sismos:
             result["errors"].append("No se obtuvieron sismos desde ArcGIS")
+            wait([existing_future])
             serial = convert_decimals(result)
-            return {"statusCode": 404, "body": json.dumps(serial, ensure_ascii=False)}
+            return {"statusCode": 404, "body": orjson.dumps(serial).decode("utf-8")}
     except Exception as e:
         tb = traceback.format_exc()
         result["errors"].append("Error fetch: " + repr(e))
         result["errors"].append(tb)
+        # no dejar el scan corriendo hacia el freeze de Lambda: encolaría el de la siguiente invocación
+        wait([existing_future])
         serial = convert_decimals(result)
-        return {"statusCode": 500, "body": json.dumps(serial, ensure_ascii=False)}
+        return {"statusCode": 500, "body": orjson.dumps(serial).decode("utf-8")}
 
     try:
-        # borrar items previos (si existen)
-        try:
-            scan_resp = table_db.scan(ProjectionExpression="id")
-            existing = scan_resp.get("Items", []) or []
-            if existing:
-                with table_db.batch_writer() as batch:
-                    for it in existing:
-                        if "id" in it:
-                            batch.delete_item(Key={"id": it["id"]})
-        except Exception as e_scan:
-            result["errors"].append("Warn scan/delete: " + repr(e_scan))
-
+        # id de respaldo para features sin OBJECTID: aws_request_id ya es único por invocación
+        base_id = getattr(context, "aws_request_id", None) or "local"
+        # BatchWriteItem rechaza dos operaciones sobre la misma clave en un request:
+        # si un id se repite gana la última aparición (como overwrite_by_pkeys)
+        by_id = {}
         for idx, s in enumerate(sismos, start=1):
             item = dict(s)
-            item["id"] = str(uuid.uuid4())
+            item.setdefault("id", base_id + "-" + str(idx))
+            by_id.pop(item["id"], None)
+            by_id[item["id"]] = item
+        items = list(by_id.values())
+        for idx, item in enumerate(items, start=1):
             item["numero"] = idx
-            cleaned = clean_item_for_dynamo(item)
-            table_db.put_item(Item=cleaned)
-            result["saved"] += 1
-            if len(result["sample_saved"]) < 5:
-                result["sample_saved"].append(cleaned)
+        new_ids = set(by_id)
 
+        # items previos (si existen); solo se borran los que no vuelven a escribirse
+        existing = set()
+        scan_ok = False
         try:
-            after = table_db.scan(Limit=20)
-            result["table_after_save_count"] = len(after.get("Items", []) or [])
-        except Exception as e_after:
-            result["errors"].append("Warn scan after: " + repr(e_after))
+            existing = existing_future.result()
+            scan_ok = True
+        except Exception as e_scan:
+            result["errors"].append("Warn scan/delete: " + repr(e_scan))
+
+        # puts + deletes en BatchWriteItem de 25: un round-trip por bloque en lugar de uno por item.
+        # Los puts van primero: si falla un bloque posterior, los obsoletos siguen en la tabla
+        # en lugar de quedar borrados sin que los nuevos se hayan escrito
+        write_requests = [{"PutRequest": {"Item": {k: to_dynamo_attr(v) for k, v in item.items()}}}
+                          for item in items]
+        write_requests.extend(
+            {"DeleteRequest": {"Key": {"id": {"S": stale_id}}}}
+            for stale_id in existing - new_ids
+        )
+        batch_write(write_requests)
+        result["saved"] = len(items)
+        result["sample_saved"] = items[:5]
+
+        # tras borrar los obsoletos, la tabla contiene exactamente lo que se acaba de escribir;
+        # si el scan falló no se borró nada y el tamaño real es desconocido
+        result["table_after_save_count"] = len(new_ids) if scan_ok else None
 
     except ClientError as ce:
         tb = traceback.format_exc()
         result["errors"].append("Dynamo ClientError: " + repr(ce))
         result["errors"].append(tb)
         serial = convert_decimals(result)
-        return {"statusCode": 500, "body": json.dumps(serial, ensure_ascii=False)}
+        return {"statusCode": 500, "body": orjson.dumps(serial).decode("utf-8")}
     except Exception as e:
         tb = traceback.format_exc()
         result["errors"].append("Write error: " + repr(e))
         result["errors"].append(tb)
         serial = convert_decimals(result)
-        return {"statusCode": 500, "body": json.dumps(serial, ensure_ascii=False)}
+        return {"statusCode": 500, "body": orjson.dumps(serial).decode("utf-8")}
 
     # convertir Decimals antes de loguear / devolver
     serializable_result = convert_decimals(result)
-    print("[lambda] resultado final:", json.dumps(serializable_result, ensure_ascii=False))
-    return {"statusCode": 200, "body": json.dumps(serializable_result, ensure_ascii=False)}
+    body = orjson.dumps(serializable_result).decode("utf-8")
+    print("[lambda] resultado final:", body)
+    return {"statusCode": 200, "body": body}